@@ -1,4 +1,3 @@
-from __future__ import division
 import numpy as np
 
 from I3Tray import I3Tray, I3Units
@@ -6,6 +5,43 @@ from icecube import icetray, dataclasses
 
 from . import geometry
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# resolve the icecube enum attribute chains once at import time
+_PType = dataclasses.I3Particle.ParticleType
+_NuE, _NuMu, _NuTau = _PType.NuE, _PType.NuMu, _PType.NuTau
+_EMinus, _MuMinus, _TauMinus = _PType.EMinus, _PType.MuMinus, _PType.TauMinus
+_Hadrons = _PType.Hadrons
+_Cascade = dataclasses.I3Particle.Cascade
+_InfTrack = dataclasses.I3Particle.InfiniteTrack
+_InIce = dataclasses.I3Particle.LocationType.InIce
+
+
+def _derive_energies_numpy(log_primary_energy, fraction, gev,
+                           primary_energy, hadron_energy, daughter_energy):
+    """Numpy fallback for the energy kernel if numba is not installed.
+    """
+    np.multiply(10**log_primary_energy, gev, out=primary_energy)
+    np.multiply(primary_energy, fraction, out=hadron_energy)
+    np.subtract(primary_energy, hadron_energy, out=daughter_energy)
+
+
+if numba is not None:
+    # cache=True: the compiled kernel is cached on disk, so the JIT
+    # warmup only happens once per installation
+    @numba.njit(cache=True, fastmath=True)
+    def _derive_energies(log_primary_energy, fraction, gev,
+                         primary_energy, hadron_energy, daughter_energy):
+        for i in range(log_primary_energy.shape[0]):
+            primary_energy[i] = 10.0**log_primary_energy[i] * gev
+            hadron_energy[i] = primary_energy[i] * fraction[i]
+            daughter_energy[i] = primary_energy[i] - hadron_energy[i]
+else:
+    _derive_energies = _derive_energies_numpy
+
 
 class CascadeFactory(icetray.I3ConditionalModule):
     def __init__(self, context):
@@ -106,8 +142,18 @@ class CascadeFactory(icetray.I3ConditionalModule):
         self.num_interaction_types = len(self.interaction_types)
         self.random_state = self.GetParameter('random_state')
         self.random_service = self.GetParameter('random_service')
-        if not isinstance(self.random_state, np.random.RandomState):
-            self.random_state = np.random.RandomState(self.random_state)
+        if not isinstance(self.random_state, np.random.Generator):
+            if isinstance(self.random_state, np.random.RandomState):
+                # map a legacy RandomState instance to a seed drawn from it
+                seed = self.random_state.randint(2**31)
+            else:
+                seed = self.random_state
+            # Offset the seed with a draw from the per-run random service,
+            # so that the pre-sampled values below differ between runs
+            # (the random_state seed is identical for all runs of a dataset).
+            if self.random_service is not None:
+                seed += self.random_service.integer(2**31)
+            self.random_state = np.random.default_rng(seed)
         self.num_events = self.GetParameter('num_events')
         self.oversampling_factor = self.GetParameter('oversampling_factor')
         if self.oversampling_factor is None:
@@ -142,10 +188,68 @@ class CascadeFactory(icetray.I3ConditionalModule):
             if flavor not in ['nue', 'numu', 'nutau']:
                 raise ValueError('Flavor unknown: {!r}'.format(flavor))
 
+        frac_lo, frac_hi = self.fractional_energy_in_hadrons_range
+        if frac_lo < 0. or frac_hi > 1. or frac_lo > frac_hi:
+            raise ValueError('Fraction range invalid: {!r}'.format(
+                self.fractional_energy_in_hadrons_range))
+
         if self.oversampling_factor < 1:
             raise ValueError('Oversampling must be set to "None" or integer'
                              ' greater than 1. It is currently set to: '
                              '{!r}'.format(self.oversampling_factor))
+
+        # ---------------------------------
+        # pre-sample per-event random draws
+        # ---------------------------------
+        # All uniform samples for the run are drawn and unit-scaled in one
+        # vectorized call each, instead of ~10 individual calls to the
+        # random service per frame. Column order of the sample matrix:
+        # (x, y, z, time, azimuth, zenith, log_primary_energy, fraction)
+        if self.sample_in_cos:
+            zenith_lo, zenith_hi = self.cos_zenith_range
+            zenith_scale = 1.
+        else:
+            zenith_lo, zenith_hi = self.zenith_range
+            zenith_scale = I3Units.deg
+        self._lows = np.array([
+            self.x_range[0], self.y_range[0], self.z_range[0],
+            self.time_range[0], self.azimuth_range[0], zenith_lo,
+            self.log_primary_energy_range[0],
+            self.fractional_energy_in_hadrons_range[0]])
+        self._highs = np.array([
+            self.x_range[1], self.y_range[1], self.z_range[1],
+            self.time_range[1], self.azimuth_range[1], zenith_hi,
+            self.log_primary_energy_range[1],
+            self.fractional_energy_in_hadrons_range[1]])
+        self._unit_scale = np.array(
+            [I3Units.m]*3 + [I3Units.ns, I3Units.deg, zenith_scale, 1., 1.])
+        self._draws = self.random_state.uniform(
+            self._lows, self._highs, size=(self.num_events, 8))
+        self._draws *= self._unit_scale
+        idx = self.random_state.integers(
+            [self.num_flavors, self.num_interaction_types],
+            size=(self.num_events, 2))
+        self._flavor_idx = idx[:, 0]
+        self._int_idx = idx[:, 1]
+
+        # -------------------------------------------
+        # precompute constant lookups for the DAQ loop
+        # -------------------------------------------
+        self._deg = I3Units.deg
+        self._GeV = I3Units.GeV
+        self._c = dataclasses.I3Constants.c
+
+        # (flavor, interaction_type) -> (primary type, daughter type,
+        #                                daughter shape)
+        self._ptype_table = {
+            ('nue', 'cc'): (_NuE, _EMinus, _Cascade),
+            ('nue', 'nc'): (_NuE, _NuE, _Cascade),
+            ('numu', 'cc'): (_NuMu, _MuMinus, _InfTrack),
+            ('numu', 'nc'): (_NuMu, _NuMu, _Cascade),
+            ('nutau', 'cc'): (_NuTau, _TauMinus, _Cascade),
+            ('nutau', 'nc'): (_NuTau, _NuTau, _Cascade),
+        }
+
         # --------------------
         # sample constant vars
         # --------------------
@@ -172,7 +276,7 @@ class CascadeFactory(icetray.I3ConditionalModule):
         # energy
         if 'primary_energy' in self.constant_vars:
             self.log_primary_energy = self.random_service.uniform(
-                                *self.log_primary_energy_range) * I3Units.GeV
+                                *self.log_primary_energy_range)
         if 'fractional_energy_in_hadrons' in self.constant_vars:
             self.fraction = self.random_service.uniform(
                                     *self.fractional_energy_in_hadrons_range)
@@ -186,9 +290,35 @@ class CascadeFactory(icetray.I3ConditionalModule):
                     self.random_service.integer(self.num_interaction_types)]
         # --------------------
 
-    def _sample_vertex(self):
+        # ----------------------------------
+        # derive per-event energies in batch
+        # ----------------------------------
+        if 'primary_energy' in self.constant_vars:
+            log_primary_energy = np.full(self.num_events,
+                                         self.log_primary_energy)
+        else:
+            log_primary_energy = self._draws[:, 6]
+        if 'fractional_energy_in_hadrons' in self.constant_vars:
+            fraction = np.full(self.num_events, self.fraction)
+        else:
+            fraction = self._draws[:, 7]
+        self._primary_energy = np.empty(self.num_events)
+        self._hadron_energy = np.empty(self.num_events)
+        self._daughter_energy = np.empty(self.num_events)
+        _derive_energies(log_primary_energy, fraction, self._GeV,
+                         self._primary_energy, self._hadron_energy,
+                         self._daughter_energy)
+
+    def _sample_vertex(self, xyz=None):
         """Sample a vertex within allowd distance of IceCube Convex Hull.
 
+        Parameters
+        ----------
+        xyz : array_like, optional
+            Pre-sampled, unit-scaled vertex coordinates to use for the
+            first attempt. If None or if the resulting vertex is rejected,
+            new coordinates are drawn from the numpy random state.
+
         Returns
         -------
         TYPE
@@ -197,15 +327,13 @@ class CascadeFactory(icetray.I3ConditionalModule):
         # vertex
         point_is_inside = False
         while not point_is_inside:
-            vertex_x = self.random_service.uniform(*self.x_range) * I3Units.m
-            vertex_y = self.random_service.uniform(*self.y_range) * I3Units.m
-            vertex_z = self.random_service.uniform(*self.z_range) * I3Units.m
-            vertex = dataclasses.I3Position(
-                            vertex_x * I3Units.m,
-                            vertex_y * I3Units.m,
-                            vertex_z * I3Units.m)
+            if xyz is None:
+                xyz = self.random_state.uniform(
+                    self._lows[:3], self._highs[:3]) * self._unit_scale[:3]
+            vertex = dataclasses.I3Position(xyz[0], xyz[1], xyz[2])
             dist = geometry.distance_to_icecube_hull(vertex)
             point_is_inside = dist < self.max_vertex_distance
+            xyz = None
         return vertex
 
     def DAQ(self, frame):
@@ -224,60 +352,51 @@ class CascadeFactory(icetray.I3ConditionalModule):
         # --------------
         # sample cascade
         # --------------
+        # bind hot attributes as locals: LOAD_FAST instead of LOAD_ATTR
+        event_id = self.events_done
+        constant_vars = self.constant_vars
+
+        # pre-sampled, unit-scaled values of this event
+        sample = self._draws[event_id]
+
         # vertex
-        if 'vertex' in self.constant_vars:
+        if 'vertex' in constant_vars:
             vertex = self.vertex
         else:
-            vertex = self._sample_vertex()
+            vertex = self._sample_vertex(xyz=sample[:3])
 
-        if 'time' in self.constant_vars:
+        if 'time' in constant_vars:
             vertex_time = self.vertex_time
         else:
-            vertex_time = \
-                self.random_service.uniform(*self.time_range)*I3Units.ns
+            vertex_time = sample[3]
 
         # direction
-        if 'azimuth' in self.constant_vars:
+        if 'azimuth' in constant_vars:
             azimuth = self.azimuth
         else:
-            azimuth = \
-                self.random_service.uniform(*self.azimuth_range)*I3Units.deg
-        if 'zenith' in self.constant_vars:
+            azimuth = sample[4]
+        if 'zenith' in constant_vars:
             zenith = self.zenith
         else:
             if self.sample_in_cos:
-                zenith = np.rad2deg(np.arccos(
-                    self.random_service.uniform(*self.cos_zenith_range)))
+                zenith = np.rad2deg(np.arccos(sample[5]))*self._deg
             else:
-                zenith = self.random_service.uniform(*self.zenith_range)
-            zenith = zenith*I3Units.deg
+                zenith = sample[5]
 
-        # energy
-        if 'primary_energy' in self.constant_vars:
-            log_primary_energy = self.log_primary_energy
-        else:
-            log_primary_energy = self.random_service.uniform(
-                                *self.log_primary_energy_range) * I3Units.GeV
-        primary_energy = 10**log_primary_energy
-        if 'fractional_energy_in_hadrons' in self.constant_vars:
-            fraction = self.fraction
-        else:
-            fraction = self.random_service.uniform(
-                                    *self.fractional_energy_in_hadrons_range)
-        hadron_energy = primary_energy * fraction
-        daughter_energy = primary_energy - hadron_energy
+        # energy (derived for all events of the run in Configure)
+        primary_energy = self._primary_energy[event_id]
+        hadron_energy = self._hadron_energy[event_id]
+        daughter_energy = self._daughter_energy[event_id]
 
         # flavor and interaction
-        if 'flavor' in self.constant_vars:
+        if 'flavor' in constant_vars:
             flavor = self.flavor
         else:
-            flavor = \
-                self.flavors[self.random_service.integer(self.num_flavors)]
-        if 'interaction_type' in self.constant_vars:
+            flavor = self.flavors[self._flavor_idx[event_id]]
+        if 'interaction_type' in constant_vars:
             interaction_type = self.interaction_type
         else:
-            interaction_type = self.interaction_types[
-                    self.random_service.integer(self.num_interaction_types)]
+            interaction_type = self.interaction_types[self._int_idx[event_id]]
 
         # create pseduo I3MCWeightDict
         mc_dict = {}
@@ -289,63 +408,44 @@ class CascadeFactory(icetray.I3ConditionalModule):
             mc_dict['InteractionType'] = 2
         frame['I3MCWeightDict'] = dataclasses.I3MapStringDouble(mc_dict)
 
-        # create particle
+        # create particles
+        # Note: these must be fresh I3Particles for every event, since the
+        # copy constructor in the oversampling loop below preserves the
+        # particle IDs assigned at construction. Only oversampled copies
+        # of the same event may share IDs.
         primary = dataclasses.I3Particle()
         daughter = dataclasses.I3Particle()
 
-        primary.time = vertex_time * I3Units.ns
+        primary.speed = self._c
+        daughter.speed = self._c
+        # Assume the vertex position in range is in ice, so the primary is
+        # the in ice neutrino that interacts
+        primary.location_type = _InIce
+        daughter.location_type = _InIce
+
+        primary.time = vertex_time
         primary.dir = dataclasses.I3Direction(zenith, azimuth)
-        primary.energy = primary_energy * I3Units.GeV
+        primary.energy = primary_energy
         primary.pos = vertex
-        primary.speed = dataclasses.I3Constants.c
-        # Assume the vertex position in range is in ice, so the primary is the
-        # in ice neutrino that interacts
-        primary.location_type = dataclasses.I3Particle.LocationType.InIce
-        daughter.location_type = dataclasses.I3Particle.LocationType.InIce
 
         daughter.time = primary.time
         daughter.dir = primary.dir
-        daughter.speed = primary.speed
         daughter.pos = primary.pos
-        daughter.energy = daughter_energy * I3Units.GeV
+        daughter.energy = daughter_energy
 
-        if interaction_type == 'cc' and flavor == 'numu':
-            daughter.shape = dataclasses.I3Particle.InfiniteTrack
-        else:
-            daughter.shape = dataclasses.I3Particle.Cascade
-
-        if flavor == 'numu':
-            primary.type = dataclasses.I3Particle.ParticleType.NuMu
-            if interaction_type == 'cc':
-                daughter.type = dataclasses.I3Particle.ParticleType.MuMinus
-            elif interaction_type == 'nc':
-                daughter.type = dataclasses.I3Particle.ParticleType.NuMu
-        elif flavor == 'nutau':
-            primary.type = dataclasses.I3Particle.ParticleType.NuTau
-            if interaction_type == 'cc':
-                daughter.type = dataclasses.I3Particle.ParticleType.TauMinus
-            elif interaction_type == 'nc':
-                daughter.type = dataclasses.I3Particle.ParticleType.NuTau
-        elif flavor == 'nue':
-            primary.type = dataclasses.I3Particle.ParticleType.NuE
-            if interaction_type == 'cc':
-                daughter.type = dataclasses.I3Particle.ParticleType.EMinus
-            elif interaction_type == 'nc':
-                daughter.type = dataclasses.I3Particle.ParticleType.NuE
-        else:
-            raise ValueError(('particle_type {!r} not known or not ' +
-                              'implemented'.format(self.particle_type)))
+        primary.type, daughter.type, daughter.shape = \
+            self._ptype_table[(flavor, interaction_type)]
 
-        # add hadrons
+        # create hadrons
         hadrons = dataclasses.I3Particle()
-        hadrons.energy = hadron_energy * I3Units.GeV
+        hadrons.speed = self._c
+        hadrons.location_type = _InIce
+        hadrons.type = _Hadrons
+        hadrons.shape = _Cascade
+        hadrons.energy = hadron_energy
         hadrons.pos = daughter.pos
         hadrons.time = daughter.time
         hadrons.dir = daughter.dir
-        hadrons.speed = daughter.speed
-        hadrons.type = dataclasses.I3Particle.ParticleType.Hadrons
-        hadrons.location_type = daughter.location_type
-        hadrons.shape = dataclasses.I3Particle.Cascade
 
         # oversampling
         for i in range(self.oversampling_factor):
@@ -365,7 +465,7 @@ class CascadeFactory(icetray.I3ConditionalModule):
             frame['I3MCTree_preMuonProp'] = mctree
             if self.oversampling_factor > 1:
                 frame['oversampling'] = dataclasses.I3MapStringInt({
-                                        'event_num_in_run': self.events_done,
+                                        'event_num_in_run': event_id,
                                         'oversampling_num': i,
                                     })
             self.PushFrame(frame)
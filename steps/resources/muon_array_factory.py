@@ -0,0 +1,238 @@
+import math
+
+import numpy as np
+
+from I3Tray import I3Units
+from icecube import icetray, dataclasses
+
+from . import geometry
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# resolve the icecube enum attribute chains once at import time
+_MuMinus = dataclasses.I3Particle.ParticleType.MuMinus
+_InIce = dataclasses.I3Particle.LocationType.InIce
+_c = dataclasses.I3Constants.c
+
+
+def _compute_vertices_numpy(azimuth, zenith, anchor_x, anchor_y, anchor_z,
+                            lengths, vertex_x, vertex_y, vertex_z):
+    """Numpy fallback for the vertex kernel if numba is not installed.
+    """
+    sin_zenith = np.sin(zenith)
+    dir_x = -sin_zenith*np.cos(azimuth)
+    dir_y = -sin_zenith*np.sin(azimuth)
+    dir_z = -np.cos(zenith)
+    np.subtract(anchor_x, lengths*dir_x, out=vertex_x)
+    np.subtract(anchor_y, lengths*dir_y, out=vertex_y)
+    np.subtract(anchor_z, lengths*dir_z, out=vertex_z)
+
+
+if numba is not None:
+    # cache=True: the compiled kernel is cached on disk, so the JIT
+    # warmup only happens once per installation
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _compute_vertices(azimuth, zenith, anchor_x, anchor_y, anchor_z,
+                          lengths, vertex_x, vertex_y, vertex_z):
+        for i in numba.prange(azimuth.shape[0]):
+            sin_zenith = math.sin(zenith[i])
+            dir_x = -sin_zenith*math.cos(azimuth[i])
+            dir_y = -sin_zenith*math.sin(azimuth[i])
+            dir_z = -math.cos(zenith[i])
+            vertex_x[i] = anchor_x[i] - lengths[i]*dir_x
+            vertex_y[i] = anchor_y[i] - lengths[i]*dir_y
+            vertex_z[i] = anchor_z[i] - lengths[i]*dir_z
+else:
+    _compute_vertices = _compute_vertices_numpy
+
+
+class MuonArrayFactory(icetray.I3ConditionalModule):
+    def __init__(self, context):
+        """Class to create and inject muons sampled per event.
+
+        In contrast to injecting the same muon into every frame, this
+        module draws energy, direction and anchor point for all events of
+        the run in a single vectorized call per variable (structure of
+        arrays). The vertex is obtained by going back along the track from
+        the anchor point, either by a fixed length or up to the
+        intersection with a given convex hull. The per-frame work in DAQ
+        is reduced to array indexing and filling the I3Particle.
+
+        Parameters
+        ----------
+        context : TYPE
+            Description
+        """
+        icetray.I3ConditionalModule.__init__(self, context)
+        self.AddOutBox('OutBox')
+        self.AddParameter('azimuth_range',
+                          '[min, max] of muon azimuth in degree.', [0, 360])
+        self.AddParameter('zenith_range',
+                          '[min, max] of muon zenith in degree.', [0, 180])
+        self.AddParameter('energy_range',
+                          '[min, max] of muon energy in GeV.', [10000, 10000])
+        self.AddParameter('anchor_time_range',
+                          '[min, max] of anchor time in ns. Approximate time '
+                          'when the muon is in the detector at the simulated '
+                          'anchor point.',
+                          [9000, 12000])
+        self.AddParameter('anchor_x_range',
+                          '[min, max] of anchor x-coordinate in meters.',
+                          [-400, 400])
+        self.AddParameter('anchor_y_range',
+                          '[min, max] of anchor y-coordinate in meters.',
+                          [-400, 400])
+        self.AddParameter('anchor_z_range',
+                          '[min, max] of anchor z-coordinate in meters.',
+                          [-400, 400])
+        self.AddParameter('length_to_go_back',
+                          'Length in meters to go back along the track from '
+                          'the anchor point to set the vertex. Ignored if a '
+                          'convex_hull is provided.',
+                          2000)
+        self.AddParameter('convex_hull',
+                          'scipy.spatial.ConvexHull defining the desired '
+                          'convex volume. If provided, the intersection point '
+                          'with the convex hull is used as vertex instead of '
+                          'length_to_go_back.',
+                          None)
+        self.AddParameter('extend_past_hull',
+                          'Length in meters to extend the vertex past the '
+                          'convex hull.',
+                          0.)
+        self.AddParameter('random_state', '', 1337)
+        self.AddParameter('random_service', '', None)
+        self.AddParameter('num_events', '', 1)
+
+    def Configure(self):
+        """Configures MuonArrayFactory and pre-samples all events.
+        """
+        self.azimuth_range = self.GetParameter('azimuth_range')
+        self.zenith_range = self.GetParameter('zenith_range')
+        self.energy_range = self.GetParameter('energy_range')
+        self.anchor_time_range = self.GetParameter('anchor_time_range')
+        self.anchor_x_range = self.GetParameter('anchor_x_range')
+        self.anchor_y_range = self.GetParameter('anchor_y_range')
+        self.anchor_z_range = self.GetParameter('anchor_z_range')
+        self.length_to_go_back = self.GetParameter('length_to_go_back')
+        self.convex_hull = self.GetParameter('convex_hull')
+        self.extend_past_hull = self.GetParameter('extend_past_hull')
+        self.random_state = self.GetParameter('random_state')
+        self.random_service = self.GetParameter('random_service')
+        if not isinstance(self.random_state, np.random.Generator):
+            if isinstance(self.random_state, np.random.RandomState):
+                # map a legacy RandomState instance to a seed drawn from it
+                seed = self.random_state.randint(2**31)
+            else:
+                seed = self.random_state
+            # Offset the seed with a draw from the per-run random service,
+            # so that the pre-sampled values below differ between runs
+            # (the random_state seed is identical for all runs of a dataset).
+            if self.random_service is not None:
+                seed += self.random_service.integer(2**31)
+            self.random_state = np.random.default_rng(seed)
+        self.num_events = self.GetParameter('num_events')
+        self.events_done = 0
+
+        # ---------------------------------
+        # pre-sample all events of the run
+        # ---------------------------------
+        num = self.num_events
+        rng = self.random_state
+        self.azimuth = rng.uniform(*self.azimuth_range, size=num)*I3Units.deg
+        self.zenith = rng.uniform(*self.zenith_range, size=num)*I3Units.deg
+        self.energy = rng.uniform(*self.energy_range, size=num)*I3Units.GeV
+        anchor_x = rng.uniform(*self.anchor_x_range, size=num)*I3Units.m
+        anchor_y = rng.uniform(*self.anchor_y_range, size=num)*I3Units.m
+        anchor_z = rng.uniform(*self.anchor_z_range, size=num)*I3Units.m
+        anchor_time = \
+            rng.uniform(*self.anchor_time_range, size=num)*I3Units.ns
+
+        lengths = self._get_lengths_to_go_back(anchor_x, anchor_y, anchor_z)
+
+        # go back along the tracks from the anchor points
+        self.vertex_x = np.empty(num)
+        self.vertex_y = np.empty(num)
+        self.vertex_z = np.empty(num)
+        _compute_vertices(self.azimuth, self.zenith,
+                          anchor_x, anchor_y, anchor_z, lengths,
+                          self.vertex_x, self.vertex_y, self.vertex_z)
+        self.vertex_time = anchor_time - lengths / _c
+
+    def _get_lengths_to_go_back(self, anchor_x, anchor_y, anchor_z):
+        """Get the lengths to go back along the tracks for all events.
+
+        Parameters
+        ----------
+        anchor_x : np.ndarray
+            The anchor point coordinates in meters.
+        anchor_y : np.ndarray
+            The anchor point coordinates in meters.
+        anchor_z : np.ndarray
+            The anchor point coordinates in meters.
+
+        Returns
+        -------
+        np.ndarray
+            The length in meters to go back along each track.
+        """
+        if self.convex_hull is None:
+            return np.full(self.num_events,
+                           self.length_to_go_back*I3Units.m)
+
+        # direction of travel: icecube convention points from the sampled
+        # zenith/azimuth towards the detector
+        sin_zenith = np.sin(self.zenith)
+        dir_x = -sin_zenith*np.cos(self.azimuth)
+        dir_y = -sin_zenith*np.sin(self.azimuth)
+        dir_z = -np.cos(self.zenith)
+
+        lengths = np.empty(self.num_events)
+        for i in range(self.num_events):
+            t_s = geometry.get_intersections(
+                self.convex_hull,
+                v_pos=(anchor_x[i], anchor_y[i], anchor_z[i]),
+                v_dir=(dir_x[i], dir_y[i], dir_z[i]),
+                eps=1e-4)
+            length_to_go_back = -t_s[t_s <= 0.0]
+            assert len(length_to_go_back) == 1, \
+                'Is anchor point within convex_hull?'
+            lengths[i] = \
+                length_to_go_back[0] + self.extend_past_hull*I3Units.m
+        return lengths
+
+    def DAQ(self, frame):
+        """Inject muons into I3MCtree.
+
+        Parameters
+        ----------
+        frame : icetray.I3Frame.DAQ
+            An I3 q-frame.
+        """
+        event_id = self.events_done
+
+        muon = dataclasses.I3Particle()
+        muon.speed = _c
+        muon.location_type = _InIce
+        muon.type = _MuMinus
+        muon.dir = dataclasses.I3Direction(self.zenith[event_id],
+                                           self.azimuth[event_id])
+        muon.energy = self.energy[event_id]
+        muon.pos = dataclasses.I3Position(self.vertex_x[event_id],
+                                          self.vertex_y[event_id],
+                                          self.vertex_z[event_id])
+        muon.time = self.vertex_time[event_id]
+
+        # Fill muon into an MCTree
+        mctree = dataclasses.I3MCTree()
+        mctree.add_primary(muon)
+
+        frame["I3MCTree_preMuonProp"] = mctree
+        self.PushFrame(frame)
+
+        self.events_done += 1
+        if self.events_done >= self.num_events:
+            self.RequestSuspension()
@@ -1,54 +1,127 @@
-#!/bin/sh /cvmfs/icecube.opensciencegrid.org/py2-v3.0.1/icetray-start
-#METAPROJECT simulation/V06-00-03
-from __future__ import division
+#!/bin/sh /cvmfs/icecube.opensciencegrid.org/py3-v4.1.0/icetray-start
+#METAPROJECT combo/V01-00-00
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import click
 import yaml
-import numpy as np
 
-from icecube.simprod import segments
+try:
+    # libyaml bindings parse much faster than the pure-python loader
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
-from I3Tray import I3Tray, I3Units
-from icecube import icetray, dataclasses
+from utils import get_run_folder, add_writers
 
-from utils import create_random_services, get_run_folder
-from resources import geometry
-from resources.cascade_factory import CascadeFactory
-from resources.oversampling import DAQFrameMultiplier
 
+def _lazy_import_icecube():
+    """Import the icetray/icecube dependencies into the module namespace.
 
-class DummyMCTreeRenaming(icetray.I3ConditionalModule):
-    def __init__(self, context):
-        """Class to add dummy I3MCTree to frame from I3MCTree_preMuonProp
+    Booting icetray takes several seconds, so this only happens when a
+    simulation is actually run and not for --validate-only calls.
+    """
+    global segments, I3Tray, icetray, dataclasses
+    global create_random_services
+    global CascadeFactory, DAQFrameMultiplier
+    global DummyMCTreeRenaming
 
-        Parameters
-        ----------
-        context : TYPE
-            Description
-        """
-        icetray.I3ConditionalModule.__init__(self, context)
-        self.AddOutBox('OutBox')
+    from icecube.simprod import segments
 
-    def DAQ(self, frame):
-        """Inject casacdes into I3MCtree.
+    from I3Tray import I3Tray
+    from icecube import icetray, dataclasses
 
-        Parameters
-        ----------
-        frame : icetray.I3Frame.DAQ
-            An I3 q-frame.
-        """
+    from utils import create_random_services
+    from resources.cascade_factory import CascadeFactory
+    from resources.oversampling import DAQFrameMultiplier
 
-        pre_tree = frame['I3MCTree_preMuonProp']
-        frame['I3MCTree'] = dataclasses.I3MCTree(pre_tree)
-        self.PushFrame(frame)
+    class DummyMCTreeRenaming(icetray.I3ConditionalModule):
+        def __init__(self, context):
+            """Class to add dummy I3MCTree to frame from I3MCTree_preMuonProp
 
+            Parameters
+            ----------
+            context : TYPE
+                Description
+            """
+            icetray.I3ConditionalModule.__init__(self, context)
+            self.AddOutBox('OutBox')
+
+        def DAQ(self, frame):
+            """Inject casacdes into I3MCtree.
+
+            Parameters
+            ----------
+            frame : icetray.I3Frame.DAQ
+                An I3 q-frame.
+            """
+
+            pre_tree = frame['I3MCTree_preMuonProp']
+            frame['I3MCTree'] = dataclasses.I3MCTree(pre_tree)
+            self.PushFrame(frame)
+
+
+def validate_config(cfg):
+    """Validate ranges, flavors and interaction types of a config.
+
+    Mirrors the sanity checks of CascadeFactory.Configure without
+    importing any icecube modules, so config sweeps can be checked
+    without booting icetray.
+
+    Parameters
+    ----------
+    cfg : dict
+        The config dictionary of the simulation step.
+
+    Raises
+    ------
+    ValueError
+        If a range is inverted or a flavor/interaction type is unknown.
+    """
+    for key in ['azimuth_range', 'zenith_range', 'primary_energy_range',
+                'fractional_energy_in_hadrons_range', 'time_range',
+                'x_range', 'y_range', 'z_range']:
+        lo, hi = cfg[key]
+        if lo > hi:
+            raise ValueError('{} is inverted: {!r}'.format(key, [lo, hi]))
+
+    frac_lo, frac_hi = cfg['fractional_energy_in_hadrons_range']
+    if frac_lo < 0. or frac_hi > 1.:
+        raise ValueError('Fraction range invalid: {!r}'.format(
+            [frac_lo, frac_hi]))
+
+    for int_type in cfg['interaction_types']:
+        if int_type.lower() not in ['cc', 'nc']:
+            raise ValueError('Interaction unknown: {!r}'.format(int_type))
+
+    for flavor in cfg['flavors']:
+        if flavor.lower() not in ['nue', 'numu', 'nutau']:
+            raise ValueError('Flavor unknown: {!r}'.format(flavor))
+
+
+def run_one(cfg, run_number, scratch):
+    """Simulate a single run.
+
+    Parameters
+    ----------
+    cfg : str
+        Path to the yaml config file.
+    run_number : int
+        The run number to simulate.
+    scratch : bool
+        If True, write the output to the scratch file pattern.
+
+    Returns
+    -------
+    str
+        Path to the written output file.
+    """
+    _lazy_import_icecube()
 
-@click.command()
-@click.argument('cfg', type=click.Path(exists=True))
-@click.argument('run_number', type=int)
-@click.option('--scratch/--no-scratch', default=True)
-def main(cfg, run_number, scratch):
     with open(cfg, 'r') as stream:
-        cfg = yaml.full_load(stream)
+        cfg = yaml.load(stream, Loader=SafeLoader)
     cfg['run_number'] = run_number
     cfg['run_folder'] = get_run_folder(run_number)
     if scratch:
@@ -57,14 +130,20 @@ def main(cfg, run_number, scratch):
         outfile = cfg['outfile_pattern'].format(**cfg)
     outfile = outfile.replace(' ', '0')
 
-    click.echo('Run: {}'.format(run_number))
-    click.echo('Outfile: {}'.format(outfile))
-    click.echo('Azimuth: [{},{}]'.format(*cfg['azimuth_range']))
-    click.echo('Zenith: [{},{}]'.format(*cfg['zenith_range']))
-    click.echo('Energy: [{},{}]'.format(*cfg['primary_energy_range']))
-    click.echo('Vertex x: [{},{}]'.format(*cfg['x_range']))
-    click.echo('Vertex y: [{},{}]'.format(*cfg['y_range']))
-    click.echo('Vertex z: [{},{}]'.format(*cfg['z_range']))
+    click.echo(f'Run: {run_number}')
+    click.echo(f'Outfile: {outfile}')
+    az_range = cfg['azimuth_range']
+    click.echo(f'Azimuth: [{az_range[0]},{az_range[1]}]')
+    zen_range = cfg['zenith_range']
+    click.echo(f'Zenith: [{zen_range[0]},{zen_range[1]}]')
+    e_range = cfg['primary_energy_range']
+    click.echo(f'Energy: [{e_range[0]},{e_range[1]}]')
+    x_range = cfg['x_range']
+    click.echo(f'Vertex x: [{x_range[0]},{x_range[1]}]')
+    y_range = cfg['y_range']
+    click.echo(f'Vertex y: [{y_range[0]},{y_range[1]}]')
+    z_range = cfg['z_range']
+    click.echo(f'Vertex z: [{z_range[0]},{z_range[1]}]')
 
     # crate random services
     if 'random_service_use_gslrng' not in cfg:
@@ -141,55 +220,61 @@ def main(cfg, run_number, scratch):
     # --------------------------------------
     # Distance Splits
     # --------------------------------------
-    if cfg['distance_splits'] is not None:
-        click.echo('SplittingDistance: {}'.format(
-            cfg['distance_splits']))
-        distance_splits = np.atleast_1d(cfg['distance_splits'])
-        dom_limits = np.atleast_1d(cfg['threshold_doms'])
-        if len(dom_limits) == 1:
-            dom_limits = np.ones_like(distance_splits) * cfg['threshold_doms']
-        oversize_factors = np.atleast_1d(cfg['oversize_factors'])
-        order = np.argsort(distance_splits)
-
-        distance_splits = distance_splits[order]
-        dom_limits = dom_limits[order]
-        oversize_factors = oversize_factors[order]
-
-        stream_objects = generate_stream_object(distance_splits,
-                                                dom_limits,
-                                                oversize_factors)
-        tray.AddModule(OversizeSplitterNSplits,
-                       "OversizeSplitterNSplits",
-                       thresholds=distance_splits,
-                       thresholds_doms=dom_limits,
-                       oversize_factors=oversize_factors)
-        for stream_i in stream_objects:
-            outfile_i = stream_i.transform_filepath(outfile)
-            tray.AddModule("I3Writer",
-                           "writer_{}".format(stream_i.stream_name),
-                           Filename=outfile_i,
-                           Streams=[icetray.I3Frame.DAQ,
-                                    icetray.I3Frame.Physics,
-                                    icetray.I3Frame.Stream('S'),
-                                    icetray.I3Frame.Stream('M')],
-                           If=stream_i)
-            click.echo('Output ({}): {}'.format(stream_i.stream_name,
-                                                outfile_i))
-    else:
-        click.echo('Output: {}'.format(outfile))
-        tray.AddModule("I3Writer", "writer",
-                       Filename=outfile,
-                       Streams=[icetray.I3Frame.DAQ,
-                                icetray.I3Frame.Physics,
-                                icetray.I3Frame.Stream('S'),
-                                icetray.I3Frame.Stream('M')])
+    add_writers(tray, cfg, outfile)
     # --------------------------------------
 
-    click.echo('Scratch: {}'.format(scratch))
+    click.echo(f'Scratch: {scratch}')
     tray.AddModule("TrashCan", "the can")
     tray.Execute()
     tray.Finish()
 
+    return outfile
+
+
+@click.command()
+@click.argument('cfg', type=click.Path(exists=True))
+@click.argument('run_number', type=int)
+@click.option('--scratch/--no-scratch', default=True)
+@click.option('--validate-only', is_flag=True,
+              help='Only validate the config, do not run the simulation.')
+def main(cfg, run_number, scratch, validate_only):
+    if validate_only:
+        with open(cfg, 'r') as stream:
+            validate_config(yaml.load(stream, Loader=SafeLoader))
+        click.echo(f'Config is valid: {cfg}')
+        return
+    run_one(cfg, run_number, scratch)
+
+
+@click.command()
+@click.argument('cfg', type=click.Path(exists=True))
+@click.argument('run_numbers', type=int, nargs=-1, required=True)
+@click.option('--scratch/--no-scratch', default=True)
+@click.option('--maxworkers', type=int, default=None,
+              help='Number of worker processes. Defaults to the cpu count.')
+def main_batch(cfg, run_numbers, scratch, maxworkers):
+    """Simulate several independent runs in parallel.
+
+    Each run is an entirely independent simulation, so the runs are
+    distributed over a pool of worker processes. The random services are
+    seeded per run via (seed, dataset_number, run_number), so results do
+    not depend on the number of workers.
+    """
+    if maxworkers is None:
+        maxworkers = os.cpu_count()
+    with ProcessPoolExecutor(max_workers=maxworkers) as executor:
+        outfiles = list(executor.map(
+            partial(run_one, cfg, scratch=scratch), run_numbers))
+    for outfile in outfiles:
+        click.echo(f'Finished: {outfile}')
+
 
 if __name__ == '__main__':
-    main()
+    # The job templates invoke this script as
+    # `<script> CFG RUN_NUMBER [--scratch]`, so the single-run command
+    # stays the default. The parallel pool is reached via
+    # `<script> batch CFG RUN_NUMBER [RUN_NUMBER ...]`.
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        main_batch(sys.argv[2:])
+    else:
+        main()
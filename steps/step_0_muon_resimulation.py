@@ -1,11 +1,13 @@
-#!/bin/sh /cvmfs/icecube.opensciencegrid.org/py2-v2/icetray-start
-#METAPROJECT simulation/V05-01-02
-from __future__ import division
+#!/bin/sh /cvmfs/icecube.opensciencegrid.org/py3-v4.1.0/icetray-start
+#METAPROJECT combo/V01-00-00
 import click
 import yaml
-import copy
 
-import numpy as np
+try:
+    # libyaml bindings parse much faster than the pure-python loader
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 from scipy.spatial import ConvexHull
 
 from icecube.simprod import segments
@@ -13,8 +15,9 @@ from icecube.simprod import segments
 from I3Tray import I3Tray, I3Units
 from icecube import icetray, dataclasses
 
-from utils import create_random_services, get_run_folder
+from utils import create_random_services, get_run_folder, add_writers
 from resources.geometry import get_intersections
+from resources.muon_array_factory import MuonArrayFactory
 
 
 def create_muon(azimuth_range=[0, 360],
@@ -94,7 +97,7 @@ def create_muon(azimuth_range=[0, 360],
     muon.location_type = dataclasses.I3Particle.LocationType.InIce
     muon.type = dataclasses.I3Particle.ParticleType.MuMinus
     muon.dir = dataclasses.I3Direction(zenith, azimuth)
-    muon.energy = energy * I3Units.GeV
+    muon.energy = energy
 
     # ------
     # get anchor point and time in detector
@@ -134,10 +137,10 @@ def create_muon(azimuth_range=[0, 360],
 
     vertex = anchor - length_to_go_back*I3Units.m * muon.dir
     travel_time = length_to_go_back * I3Units.m / muon.speed
-    vertex_time = anchor_time - travel_time * I3Units.ns
+    vertex_time = anchor_time - travel_time
 
     muon.pos = vertex
-    muon.time = vertex_time * I3Units.ns
+    muon.time = vertex_time
 
     return muon
 
@@ -152,15 +155,17 @@ class ParticleMultiplier(icetray.I3ConditionalModule):
         self.num_events = self.GetParameter('num_events')
         self.primary = self.GetParameter('primary')
 
+        # The primary is identical for every frame, so the MCTree is
+        # built once and copy-constructed in DAQ.
+        self.proto_tree = dataclasses.I3MCTree()
+        self.proto_tree.add_primary(self.primary)
+
         self.events_done = 0
 
     def DAQ(self, frame):
 
         # Fill primary into an MCTree
-        mctree = dataclasses.I3MCTree()
-        mctree.add_primary(self.primary)
-
-        frame["I3MCTree_preMuonProp"] = mctree
+        frame["I3MCTree_preMuonProp"] = dataclasses.I3MCTree(self.proto_tree)
         self.PushFrame(frame)
 
         self.events_done += 1
@@ -174,11 +179,7 @@ class ParticleMultiplier(icetray.I3ConditionalModule):
 @click.option('--scratch/--no-scratch', default=True)
 def main(cfg, run_number, scratch):
     with open(cfg, 'r') as stream:
-        if int(yaml.__version__[0]) < 5:
-            # backwards compatibility for yaml versions before version 5
-            cfg = yaml.load(stream)
-        else:
-            cfg = yaml.full_load(stream)
+        cfg = yaml.load(stream, Loader=SafeLoader)
     cfg['run_number'] = run_number
     cfg['run_folder'] = get_run_folder(run_number)
     if scratch:
@@ -187,14 +188,11 @@ def main(cfg, run_number, scratch):
         outfile = cfg['outfile_pattern'].format(**cfg)
     outfile = outfile.replace(' ', '0')
 
-    click.echo('Run: {}'.format(run_number))
-    click.echo('Outfile: {}'.format(outfile))
-    click.echo('Azimuth: [{},{}]'.format(cfg['azimuth_min'],
-                                         cfg['azimuth_max']))
-    click.echo('Zenith: [{},{}]'.format(cfg['zenith_min'],
-                                        cfg['zenith_max']))
-    click.echo('Energy: [{},{}]'.format(cfg['e_min'],
-                                        cfg['e_max']))
+    click.echo(f'Run: {run_number}')
+    click.echo(f'Outfile: {outfile}')
+    click.echo(f"Azimuth: [{cfg['azimuth_min']},{cfg['azimuth_max']}]")
+    click.echo(f"Zenith: [{cfg['zenith_min']},{cfg['zenith_max']}]")
+    click.echo(f"Energy: [{cfg['e_min']},{cfg['e_max']}]")
 
     # crate random services
     random_services, _ = create_random_services(
@@ -233,21 +231,8 @@ def main(cfg, run_number, scratch):
 
     if 'extend_past_hull' not in cfg:
         cfg['extend_past_hull'] = 0.0
-
-    # create muon
-    muon = create_muon(
-            azimuth_range=[cfg['azimuth_min'], cfg['azimuth_max']],
-            zenith_range=[cfg['zenith_min'], cfg['zenith_max']],
-            energy_range=[cfg['e_min'], cfg['e_max']],
-            anchor_time_range=cfg['anchor_time_range'],
-            anchor_x_range=cfg['anchor_x_range'],
-            anchor_y_range=cfg['anchor_y_range'],
-            anchor_z_range=cfg['anchor_z_range'],
-            length_to_go_back=cfg['length_to_go_back'],
-            convex_hull=convex_hull,
-            extend_past_hull=cfg['extend_past_hull'],
-            random_service=random_services[0],
-            )
+    if 'resample_per_event' not in cfg:
+        cfg['resample_per_event'] = False
 
     # --------------------------------------
     # Build IceTray
@@ -257,10 +242,43 @@ def main(cfg, run_number, scratch):
                    # Prefix=gcdfile,
                    Stream=icetray.I3Frame.DAQ)
 
-    tray.AddModule(ParticleMultiplier,
-                   'make_particles',
-                   num_events=cfg['n_events_per_run'],
-                   primary=muon)
+    if cfg['resample_per_event']:
+        # sample a new muon for every event of the run
+        tray.AddModule(MuonArrayFactory,
+                       'make_particles',
+                       azimuth_range=[cfg['azimuth_min'], cfg['azimuth_max']],
+                       zenith_range=[cfg['zenith_min'], cfg['zenith_max']],
+                       energy_range=[cfg['e_min'], cfg['e_max']],
+                       anchor_time_range=cfg['anchor_time_range'],
+                       anchor_x_range=cfg['anchor_x_range'],
+                       anchor_y_range=cfg['anchor_y_range'],
+                       anchor_z_range=cfg['anchor_z_range'],
+                       length_to_go_back=cfg['length_to_go_back'],
+                       convex_hull=convex_hull,
+                       extend_past_hull=cfg['extend_past_hull'],
+                       num_events=cfg['n_events_per_run'],
+                       random_state=cfg['seed'],
+                       random_service=random_services[0])
+    else:
+        # create a single muon and re-inject it into every event
+        muon = create_muon(
+                azimuth_range=[cfg['azimuth_min'], cfg['azimuth_max']],
+                zenith_range=[cfg['zenith_min'], cfg['zenith_max']],
+                energy_range=[cfg['e_min'], cfg['e_max']],
+                anchor_time_range=cfg['anchor_time_range'],
+                anchor_x_range=cfg['anchor_x_range'],
+                anchor_y_range=cfg['anchor_y_range'],
+                anchor_z_range=cfg['anchor_z_range'],
+                length_to_go_back=cfg['length_to_go_back'],
+                convex_hull=convex_hull,
+                extend_past_hull=cfg['extend_past_hull'],
+                random_service=random_services[0],
+                )
+
+        tray.AddModule(ParticleMultiplier,
+                       'make_particles',
+                       num_events=cfg['n_events_per_run'],
+                       primary=muon)
 
     tray.AddSegment(segments.PropagateMuons,
                     'propagate_muons',
@@ -270,51 +288,10 @@ def main(cfg, run_number, scratch):
     # --------------------------------------
     # Distance Splits
     # --------------------------------------
-    if cfg['distance_splits'] is not None:
-        click.echo('SplittingDistance: {}'.format(
-            cfg['distance_splits']))
-        distance_splits = np.atleast_1d(cfg['distance_splits'])
-        dom_limits = np.atleast_1d(cfg['threshold_doms'])
-        if len(dom_limits) == 1:
-            dom_limits = np.ones_like(distance_splits) * cfg['threshold_doms']
-        oversize_factors = np.atleast_1d(cfg['oversize_factors'])
-        order = np.argsort(distance_splits)
-
-        distance_splits = distance_splits[order]
-        dom_limits = dom_limits[order]
-        oversize_factors = oversize_factors[order]
-
-        stream_objects = generate_stream_object(distance_splits,
-                                                dom_limits,
-                                                oversize_factors)
-        tray.AddModule(OversizeSplitterNSplits,
-                       "OversizeSplitterNSplits",
-                       thresholds=distance_splits,
-                       thresholds_doms=dom_limits,
-                       oversize_factors=oversize_factors)
-        for stream_i in stream_objects:
-            outfile_i = stream_i.transform_filepath(outfile)
-            tray.AddModule("I3Writer",
-                           "writer_{}".format(stream_i.stream_name),
-                           Filename=outfile_i,
-                           Streams=[icetray.I3Frame.DAQ,
-                                    icetray.I3Frame.Physics,
-                                    icetray.I3Frame.Stream('S'),
-                                    icetray.I3Frame.Stream('M')],
-                           If=stream_i)
-            click.echo('Output ({}): {}'.format(stream_i.stream_name,
-                                                outfile_i))
-    else:
-        click.echo('Output: {}'.format(outfile))
-        tray.AddModule("I3Writer", "writer",
-                       Filename=outfile,
-                       Streams=[icetray.I3Frame.DAQ,
-                                icetray.I3Frame.Physics,
-                                icetray.I3Frame.Stream('S'),
-                                icetray.I3Frame.Stream('M')])
+    add_writers(tray, cfg, outfile)
     # --------------------------------------
 
-    click.echo('Scratch: {}'.format(scratch))
+    click.echo(f'Scratch: {scratch}')
     tray.AddModule("TrashCan", "the can")
     tray.Execute()
     tray.Finish()
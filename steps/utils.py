@@ -1,8 +1,112 @@
+from collections import namedtuple
+
+import click
 import numpy as np
 
 MAX_DATASET_NUMBER = 100000
 MAX_RUN_NUMBER = 100000
 
+# streams written out by all I3Writer instances
+# (built lazily since icecube is not imported at module scope)
+_WRITER_STREAMS = None
+
+
+SplitPlan = namedtuple(
+    'SplitPlan', ['thresholds', 'dom_limits', 'oversize_factors'])
+
+
+def prepare_splits(cfg):
+    """Prepare the distance-split settings from the config.
+
+    Broadcasts a scalar DOM threshold to the number of distance splits
+    and sorts all settings by ascending split distance, so this only has
+    to be done once per process.
+
+    Parameters
+    ----------
+    cfg : dict
+        The config dictionary of the simulation step.
+
+    Returns
+    -------
+    SplitPlan or None
+        The sorted split thresholds, DOM limits and oversize factors.
+        None if distance splits are disabled in the config.
+    """
+    if cfg['distance_splits'] is None:
+        return None
+    thresholds = np.atleast_1d(cfg['distance_splits'])
+    dom_limits = np.atleast_1d(cfg['threshold_doms'])
+    if len(dom_limits) == 1:
+        dom_limits = np.broadcast_to(cfg['threshold_doms'],
+                                     thresholds.shape)
+    oversize_factors = np.atleast_1d(cfg['oversize_factors'])
+    order = np.argsort(thresholds)
+    return SplitPlan(thresholds=thresholds[order],
+                     dom_limits=dom_limits[order],
+                     oversize_factors=oversize_factors[order])
+
+
+def add_writers(tray, cfg, outfile, split_plan=None):
+    """Add the I3Writer modules for a simulation step to the tray.
+
+    If distance splits are enabled in the config, an
+    OversizeSplitterNSplits module and one writer per split stream are
+    added, otherwise a single writer. This block used to be duplicated
+    across the simulation steps.
+
+    Parameters
+    ----------
+    tray : I3Tray
+        The tray to which the modules will be added.
+    cfg : dict
+        The config dictionary of the simulation step.
+    outfile : str
+        Path to the output file.
+    split_plan : SplitPlan, optional
+        Pre-prepared distance-split settings. If None, they are prepared
+        from the config via prepare_splits.
+    """
+    global _WRITER_STREAMS
+    from icecube import icetray
+    from dom_distance_cut import OversizeSplitterNSplits, \
+        generate_stream_object
+
+    if _WRITER_STREAMS is None:
+        _WRITER_STREAMS = [icetray.I3Frame.DAQ,
+                           icetray.I3Frame.Physics,
+                           icetray.I3Frame.Stream('S'),
+                           icetray.I3Frame.Stream('M')]
+
+    if split_plan is None:
+        split_plan = prepare_splits(cfg)
+
+    if split_plan is not None:
+        click.echo('SplittingDistance: {}'.format(
+            cfg['distance_splits']))
+        stream_objects = generate_stream_object(split_plan.thresholds,
+                                                split_plan.dom_limits,
+                                                split_plan.oversize_factors)
+        tray.AddModule(OversizeSplitterNSplits,
+                       "OversizeSplitterNSplits",
+                       thresholds=split_plan.thresholds,
+                       thresholds_doms=split_plan.dom_limits,
+                       oversize_factors=split_plan.oversize_factors)
+        for stream_i in stream_objects:
+            outfile_i = stream_i.transform_filepath(outfile)
+            tray.AddModule("I3Writer",
+                           "writer_{}".format(stream_i.stream_name),
+                           Filename=outfile_i,
+                           Streams=_WRITER_STREAMS,
+                           If=stream_i)
+            click.echo('Output ({}): {}'.format(stream_i.stream_name,
+                                                outfile_i))
+    else:
+        click.echo('Output: {}'.format(outfile))
+        tray.AddModule("I3Writer", "writer",
+                       Filename=outfile,
+                       Streams=_WRITER_STREAMS)
+
 
 def create_random_services(dataset_number, run_number, seed, n_services=1,
                            use_gslrng=False):